@@ -1,60 +1,413 @@
+import asyncio
+import aiohttp
+import codecs
+import diskcache
+import faiss
+import functools
+import hashlib
+import json
+import lxml.etree
+import lxml.html
+import nltk
+import numpy as np
 import openai
-import requests
 import os
-import time
-from bs4 import BeautifulSoup
+import re
+import tempfile
+import tiktoken
 from typing import Dict, List, Union, Tuple, Optional
+from xml.sax.saxutils import escape
 from dotenv import load_dotenv
 from elevenlabs import generate, set_api_key, save
 import azure.cognitiveservices.speech as speechsdk
 import io
 from pydub import AudioSegment
 from azure.cognitiveservices.speech import SpeechSynthesisOutputFormat
+from openai import AsyncOpenAI
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+    wait_exponential_jitter,
+)
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Retries are handled by openai_retry below, so disable the client's own
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 set_api_key(os.getenv("ELEVEN_LABS_KEY"))
 azure_key, azure_service_region = os.getenv("AZURE_API_KEY"), os.getenv("AZURE_REGION")
 
+MODEL = "gpt-4o-mini"
+# JSON mode keeps replies to the summary itself, without chatty preambles
+COMPLETION_OPTIONS = {"response_format": {"type": "json_object"}, "max_tokens": 400}
+TRUNCATED_RETRY_MAX_TOKENS = 1000  # Output budget when a reply hits max_tokens
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+HN_SEARCH_URL = "http://hn.algolia.com/api/v1/search_by_date"
+HN_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HN_TIMEOUT = aiohttp.ClientTimeout(total=10)
+HEAD_TIMEOUT = aiohttp.ClientTimeout(total=5)
+PAGE_TIMEOUT = aiohttp.ClientTimeout(total=15)
+MAX_PAGE_BYTES = 2_000_000  # Larger pages are skipped rather than summarized
+
+HTTP_SEMAPHORE = asyncio.Semaphore(10)  # Maximum number of concurrent HTTP fetches
+SUMMARIZE_SEMAPHORE = asyncio.Semaphore(5)  # Maximum number of concurrent summaries
+BATCH_MIN_CHUNKS = 3  # Posts split into at least this many chunks use the Batch API
+BATCH_POLL_INTERVAL = 30  # Seconds between Batch API status checks
+BATCH_MAX_WAIT = 15 * 60  # Seconds before a batch is cancelled and summarized directly
+BATCH_CANCEL_WAIT = 60  # Seconds to wait for a cancelled batch to settle
+N_FETCH_WORKERS = 5  # Pipeline workers fetching post content
+N_SUMMARIZE_WORKERS = 3  # Pipeline workers summarizing fetched posts
+TTS_SEMAPHORE = asyncio.Semaphore(4)  # Maximum number of concurrent sentence syntheses
+STORY_PAUSE_MS = 750  # Silence between stories in the Azure podcast
+# Marks story boundaries in the podcast script; summaries themselves use at
+# most one blank line between their paragraphs
+STORY_SEPARATOR = "\n\n\n"
+
+SYSTEM_PROMPT = (
+    "Summarize the following text. "
+    "Make the summary interesting as it will be read out loud "
+    "in a podcast format. The host and audience are very interested in "
+    "programming and AI. Make it roughly two paragraphs long"
+    " add transition words before and after to make the summary flow well."
+    " as it will be combined with other summaries."
+    " start by crafting an intro sentence that hooks the audience."
+    " Then, summarize the text in a concise manner."
+    " If a title is given, use it."
+    ' Return a JSON object with a single key "summary" containing the summary.'
+)
+
+# Transient OpenAI errors worth retrying (APITimeoutError is an APIConnectionError)
+RETRYABLE_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+exponential_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def wait_retry_after(retry_state: RetryCallState) -> float:
+    # Honor the server's Retry-After hint when present, otherwise back off exponentially
+    exception = retry_state.outcome.exception()
+    response = getattr(exception, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return exponential_backoff(retry_state)
+
 
-def summarize(text: str, title: Optional[str] = None) -> str:
-    if title:
-        title = "Use the following title: " + title + "\n\n"
-    prompt = (
-        f"Summarize the following text. "
-        "Make the summary interesting as it will be read out loud "
-        "in a podcast format. The host and audience are very interested in "
-        "programming and AI. Make it roughly two paragraphs long"
-        " add transition words before and after to make the summary flow well."
-        " as it will be combined with other summaries."
-        " start by crafting an intro sentence that hooks the audience."
-        " Then, summarize the text in a concise manner."
-        f"{title if title else ''}"
-        f"\n\nText: {text}\n\nSummary:"
+def log_retry(retry_state: RetryCallState) -> None:
+    print(
+        f"OpenAI error: {retry_state.outcome.exception()}. "
+        f"Waiting {retry_state.next_action.sleep:.1f} seconds before retrying..."
     )
 
-    max_retries = 5  # OpenAI API maximum number of retries
-    delay = 10  # OpenAI API between retries in seconds
 
-    for i in range(max_retries):
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}]
+openai_retry = retry(
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    before_sleep=log_retry,
+    reraise=True,
+)
+
+
+def parse_reset_duration(value: str) -> float:
+    # x-ratelimit-reset-* headers look like "20ms", "1s" or "6m0s"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(amount) * units[unit]
+        for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    )
+
+
+class RateLimiter:
+    """
+    Pace OpenAI chat completions using the x-ratelimit-* response headers
+
+    parameters:
+        client: AsyncOpenAI client used to send requests
+        model: Chat model name, also used to pick the tiktoken encoding
+        max_concurrent_requests: Maximum number of requests in flight at once
+    """
+
+    def __init__(self, client: AsyncOpenAI, model: str, max_concurrent_requests: int):
+        self.client = client
+        self.model = model
+        self.encoding = tiktoken.encoding_for_model(model)
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.lock = asyncio.Lock()
+
+        # Unknown until the first response reports them
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+
+    async def _acquire(self, est_tokens: int) -> None:
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                # Once a window resets the budget is full again until the next response
+                if now >= self.requests_reset_at:
+                    self.remaining_requests = None
+                if now >= self.tokens_reset_at:
+                    self.remaining_tokens = None
+
+                wait = 0.0
+                if self.remaining_requests is not None and self.remaining_requests < 1:
+                    wait = max(wait, self.requests_reset_at - now)
+                if (
+                    self.remaining_tokens is not None
+                    and self.remaining_tokens < est_tokens
+                ):
+                    wait = max(wait, self.tokens_reset_at - now)
+                if wait <= 0:
+                    break
+                print(f"Rate limit budget exhausted, waiting {wait:.1f} seconds...")
+                await asyncio.sleep(wait)
+
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None:
+                self.remaining_tokens -= est_tokens
+
+    def _update(self, headers) -> None:
+        now = asyncio.get_running_loop().time()
+        if "x-ratelimit-remaining-requests" in headers:
+            self.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            self.requests_reset_at = now + parse_reset_duration(
+                headers.get("x-ratelimit-reset-requests", "")
             )
-            return response["choices"][0]["message"]["content"]
-            break  # exit the loop if successful
-        except openai.error.RateLimitError as e:
-            print("Rate limit error:", e)
-            if i < max_retries - 1:  #
-                print(f"Waiting {delay} seconds before retrying...")
-                time.sleep(delay)
-            else:
-                print(
-                    "Maximum number of retries reached. Please try again later or contact OpenAI support."
+        if "x-ratelimit-remaining-tokens" in headers:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            self.tokens_reset_at = now + parse_reset_duration(
+                headers.get("x-ratelimit-reset-tokens", "")
+            )
+
+    async def create(
+        self, messages: List[Dict[str, str]], **options
+    ) -> openai.types.chat.ChatCompletion:
+        # The token budget is charged for max_tokens up front, not just the prompt
+        est_tokens = options.get("max_tokens", 0) + sum(
+            len(self.encoding.encode(message["content"])) for message in messages
+        )
+        await self._acquire(est_tokens)
+        async with self.semaphore:
+            try:
+                raw_response = (
+                    await self.client.chat.completions.with_raw_response.create(
+                        model=self.model, messages=messages, **options
+                    )
+                )
+            except openai.APIStatusError as e:
+                # 429s carry the same headers, so learn from them before retrying
+                self._update(e.response.headers)
+                raise
+        self._update(raw_response.headers)
+        return raw_response.parse()
+
+
+rate_limiter = RateLimiter(client, MODEL, max_concurrent_requests=10)
+
+
+def parse_summary(content: Optional[str]) -> Optional[str]:
+    # None means there is no usable summary, so it is neither cached nor read out
+    if not content:
+        return None
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError:
+        parsed = None
+    if isinstance(parsed, dict):
+        if isinstance(parsed.get("summary"), str):
+            text = parsed["summary"]
+        else:
+            # Unexpected key names; keep the text values rather than the raw JSON
+            text = " ".join(v for v in parsed.values() if isinstance(v, str))
+        return text.strip() or None
+
+    # Salvage the text from a reply that is still cut off mid-JSON, so the
+    # podcast script never gets braces and quotes read aloud
+    match = re.match(r'\s*\{\s*"summary"\s*:\s*"(.*)', content, re.DOTALL)
+    if not match:
+        return content.strip() or None
+    text = re.sub(r'"\s*}?\s*$', "", match.group(1))
+    # Drop a trailing partial escape sequence (at most "\uXXX") until it decodes
+    for end in range(len(text), max(len(text) - 6, 0) - 1, -1):
+        try:
+            return json.loads(f'"{text[:end]}"').strip() or None
+        except json.JSONDecodeError:
+            continue
+    return text.strip() or None
+
+
+@openai_retry
+async def create_chat_completion(messages: List[Dict[str, str]]) -> Optional[str]:
+    completion = await rate_limiter.create(messages, **COMPLETION_OPTIONS)
+    if completion.choices[0].finish_reason == "length":
+        # A truncated JSON reply isn't usable as-is, so ask again with more room
+        print("Summary hit max_tokens, retrying with a larger limit...")
+        completion = await rate_limiter.create(
+            messages, **{**COMPLETION_OPTIONS, "max_tokens": TRUNCATED_RETRY_MAX_TOKENS}
+        )
+    return parse_summary(completion.choices[0].message.content)
+
+
+@openai_retry
+async def create_embedding(text: str) -> np.ndarray:
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return np.array(response.data[0].embedding, dtype="float32")
+
+
+class LLMCache:
+    """
+    Persist completions on disk, keyed by message hash or by embedding similarity
+
+    parameters:
+        directory: Directory holding the diskcache store
+        similarity_threshold: Minimum cosine similarity for a semantic cache hit
+    """
+
+    def __init__(self, directory: str, similarity_threshold: float):
+        self.cache = diskcache.Cache(directory)
+        self.similarity_threshold = similarity_threshold
+
+        # Rebuild the in-memory vector index from embeddings saved by earlier runs
+        self.index = faiss.IndexFlatIP(EMBEDDING_DIMENSIONS)
+        self.index_keys: List[str] = []
+        for cache_key in self.cache.iterkeys():
+            if cache_key.startswith("embedding:"):
+                self._add_to_index(
+                    cache_key[len("embedding:") :], self.cache[cache_key]
                 )
 
+    @staticmethod
+    def make_key(messages: List[Dict[str, str]]) -> str:
+        return hashlib.sha256(f"{MODEL}|{json.dumps(messages)}".encode()).hexdigest()
+
+    def _add_to_index(self, key: str, embedding: np.ndarray) -> None:
+        vector = embedding.reshape(1, -1).copy()
+        faiss.normalize_L2(vector)  # Inner product of unit vectors is cosine similarity
+        self.index.add(vector)
+        self.index_keys.append(key)
+
+    def get(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        return self.cache.get(f"summary:{self.make_key(messages)}")
 
-def get_hn_posts(post_type: str, num_posts: int) -> List[Dict[str, Union[str, int]]]:
+    def get_similar(
+        self, embedding: np.ndarray, title: Optional[str] = None
+    ) -> Optional[str]:
+        if self.index.ntotal == 0:
+            return None
+        vector = embedding.reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        scores, ids = self.index.search(vector, min(5, self.index.ntotal))
+        for score, index_id in zip(scores[0], ids[0]):
+            if score < self.similarity_threshold:
+                break
+            # Summaries are written around their title, so only reuse one whose
+            # title matches (e.g. the same boilerplate page behind two stories)
+            key = self.index_keys[index_id]
+            if self.cache.get(f"title:{key}") == title:
+                return self.cache.get(f"summary:{key}")
+        return None
+
+    def set(
+        self,
+        messages: List[Dict[str, str]],
+        summary: str,
+        embedding: Optional[np.ndarray] = None,
+        title: Optional[str] = None,
+    ) -> None:
+        key = self.make_key(messages)
+        self.cache[f"summary:{key}"] = summary
+        if embedding is not None:
+            self.cache[f"title:{key}"] = title
+            self.cache[f"embedding:{key}"] = embedding
+            self._add_to_index(key, embedding)
+
+
+llm_cache = LLMCache("./.llm_cache", similarity_threshold=0.97)
+
+
+def build_messages(text: str, title: Optional[str] = None) -> List[Dict[str, str]]:
+    # Only the user message varies, so the system prompt is a shared cacheable prefix
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": (f"Title: {title}\n\n" if title else "") + text},
+    ]
+
+
+async def summarize(text: str, title: Optional[str] = None) -> Optional[str]:
+    messages = build_messages(text, title)
+
+    cached_summary = llm_cache.get(messages)
+    if cached_summary is not None:
+        return cached_summary
+
+    try:
+        embedding = await create_embedding(text)
+    except openai.OpenAIError as e:
+        # e.g. text over the embedding model's context limit; the chat model may
+        # still accept it, so carry on without the semantic lookup
+        print(f"Embedding failed, skipping semantic cache: {e}")
+        embedding = None
+    if embedding is not None:
+        similar_summary = llm_cache.get_similar(embedding, title)
+        if similar_summary is not None:
+            return similar_summary
+
+    try:
+        summary = await create_chat_completion(messages)
+        if summary is None:
+            print(f"OpenAI returned no usable summary for {title or 'chunk'}")
+            return None
+        llm_cache.set(messages, summary, embedding, title)
+        return summary
+    except RETRYABLE_OPENAI_ERRORS as e:
+        print(f"OpenAI error: {e}")
+        print(
+            "Maximum number of retries reached. Please try again later or contact OpenAI support."
+        )
+
+
+def is_retryable_hn_error(exception: BaseException) -> bool:
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status in HN_RETRY_STATUSES
+    return isinstance(exception, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+@retry(
+    retry=retry_if_exception(is_retryable_hn_error),
+    wait=wait_exponential(multiplier=0.5),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def search_hn(
+    session: aiohttp.ClientSession, params: Dict[str, Union[str, int]]
+) -> List[Dict[str, Union[str, int]]]:
+    async with HTTP_SEMAPHORE:
+        async with session.get(
+            HN_SEARCH_URL, params=params, timeout=HN_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data["hits"]
+
+
+async def get_hn_posts(
+    session: aiohttp.ClientSession, post_type: str, num_posts: int
+) -> List[Dict[str, Union[str, int]]]:
     params = {
         "query": "",
         "tags": post_type,
@@ -63,15 +416,12 @@ def get_hn_posts(post_type: str, num_posts: int) -> List[Dict[str, Union[str, in
         "page": 0,
     }
 
-    response = requests.get(
-        "http://hn.algolia.com/api/v1/search_by_date", params=params
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["hits"]
+    return await search_hn(session, params)
 
 
-def get_comments_from_post(post_id: str) -> List[Dict[str, Union[str, int]]]:
+async def get_comments_from_post(
+    session: aiohttp.ClientSession, post_id: str
+) -> List[Dict[str, Union[str, int]]]:
     params = {
         "query": "",
         "tags": "comment,story_" + post_id,
@@ -79,109 +429,398 @@ def get_comments_from_post(post_id: str) -> List[Dict[str, Union[str, int]]]:
         "page": 0,
     }
 
-    response = requests.get(
-        "http://hn.algolia.com/api/v1/search_by_date", params=params
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["hits"]
+    return await search_hn(session, params)
+
+
+def is_small_html(response: aiohttp.ClientResponse) -> bool:
+    content_type = response.headers.get("Content-Type", "")
+    content_length = response.content_length or 0
+    return "html" in content_type and content_length <= MAX_PAGE_BYTES
 
 
-def extract_text(html_content: Optional[str]) -> Optional[str]:
-    if html_content:
-        soup = BeautifulSoup(html_content, "html.parser")
-        return " ".join(soup.stripped_strings)
-    return None
+def make_html_parser(charset: Optional[str]) -> lxml.html.HTMLParser:
+    # Charsets from the Content-Type header are server supplied; if one isn't
+    # recognised, let lxml detect the encoding itself
+    try:
+        if charset:
+            codecs.lookup(charset)
+        return lxml.html.HTMLParser(encoding=charset)
+    except LookupError:
+        return lxml.html.HTMLParser()
 
 
-def get_text_from_hn_post(
-    post: Dict[str, Union[str, int, None]]
+async def get_text_from_hn_post(
+    session: aiohttp.ClientSession, post: Dict[str, Union[str, int, None]]
 ) -> Tuple[str, Union[str, int, None]]:
     url = post.get("url")
     if url:
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
-            return ("html", soup.prettify())
-        except requests.exceptions.RequestException as e:
+            async with HTTP_SEMAPHORE:
+                # Check type and size first so PDFs, videos etc. aren't downloaded.
+                # Servers that reject or fail HEAD get the same checks on the GET.
+                try:
+                    async with session.head(
+                        url, allow_redirects=True, timeout=HEAD_TIMEOUT
+                    ) as head:
+                        if head.status < 400 and not is_small_html(head):
+                            print(f"Skipping {url}: not a reasonably sized HTML page")
+                            return ("text", post.get("story_text"))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"HEAD request to {url} failed ({e!r}), trying GET")
+
+                async with session.get(url, timeout=PAGE_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if not is_small_html(response):
+                        print(f"Skipping {url}: not a reasonably sized HTML page")
+                        return ("text", post.get("story_text"))
+
+                    # Build the tree incrementally as the body streams in
+                    parser = make_html_parser(response.charset)
+                    bytes_read = 0
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        parser.feed(chunk)
+                        bytes_read += len(chunk)
+                        if bytes_read > MAX_PAGE_BYTES:
+                            break  # No Content-Length was sent; keep what fits
+                    root = parser.close()
+            # Inline scripts and styles aren't article text
+            lxml.etree.strip_elements(
+                root, "script", "style", "template", with_tail=False
+            )
+            return ("text", re.sub(r"\s+", " ", " ".join(root.itertext())).strip())
+        except (aiohttp.ClientError, asyncio.TimeoutError, lxml.etree.LxmlError) as e:
             print(f"Failed to fetch content from {url}. Error: {e}")
             return ("ERROR", None)
     return ("text", post.get("story_text"))
 
 
-def chunk_text(text: str, max_length: int) -> List[str]:
-    words = text.split()
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    for word in words:
-        if current_length + len(word) <= max_length:
-            current_chunk.append(word)
-            current_length += len(word)
-        else:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [word]
-            current_length = len(word)
+def chunk_text(text: str, max_tokens: int, overlap: int) -> List[str]:
+    # Token-accurate windows; consecutive chunks share `overlap` tokens of context
+    encoding = tiktoken.encoding_for_model(MODEL)
+    tokens = encoding.encode(text)
+    return [
+        encoding.decode(tokens[i : i + max_tokens])
+        for i in range(0, max(len(tokens) - overlap, 1), max_tokens - overlap)
+    ]
 
-    chunks.append(" ".join(current_chunk))
-    return chunks
 
+async def summarize_chunks(chunks: List[str]) -> List[str]:
+    async def sem_summarize(chunk: str) -> str:
+        async with SUMMARIZE_SEMAPHORE:
+            return await summarize(chunk + "\nPlease provide a brief summary.")
 
-def map_title_summary(posts: List[Dict[str, Union[str, int]]]) -> Dict[str, str]:
-    title_summary_map = {}
+    # gather preserves submission order, so summaries line up with chunks
+    return await asyncio.gather(*[sem_summarize(chunk) for chunk in chunks])
 
-    for post in posts:
-        title = post.get("title")
-        post_type, content = get_text_from_hn_post(post)
-        print(f"Summarizing {title}")
-        if post_type == "ERROR":
-            continue
 
-        if post_type == "html":
-            content = extract_text(content)
+async def delete_files(*file_ids: Optional[str]) -> None:
+    for file_id in file_ids:
+        if file_id:
+            try:
+                await client.files.delete(file_id)
+            except openai.OpenAIError as e:
+                print(f"Failed to delete file {file_id}: {e}")
+
+
+async def summarize_chunks_batch(post_id: str, chunks: List[str]) -> List[str]:
+    custom_ids = [f"{post_id}_chunk_{i}" for i in range(len(chunks))]
+    chunk_messages = [
+        build_messages(chunk + "\nPlease provide a brief summary.") for chunk in chunks
+    ]
+
+    summaries = {}
+    for custom_id, messages in zip(custom_ids, chunk_messages):
+        cached_summary = llm_cache.get(messages)
+        if cached_summary is not None:
+            summaries[custom_id] = cached_summary
+    if len(summaries) == len(chunks):
+        return [summaries[custom_id] for custom_id in custom_ids]
+
+    requests_jsonl = "\n".join(
+        json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "messages": messages,
+                    **COMPLETION_OPTIONS,
+                },
+            }
+        )
+        for custom_id, messages in zip(custom_ids, chunk_messages)
+        if custom_id not in summaries
+    )
+
+    batch_file = await client.files.create(
+        file=(f"{post_id}_chunks.jsonl", requests_jsonl.encode()), purpose="batch"
+    )
+    batch = None
+    try:
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} with {len(chunks) - len(summaries)} chunks")
+
+        # Don't hold up the podcast for the whole 24h completion window
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + BATCH_MAX_WAIT
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if loop.time() >= deadline:
+                # Wait briefly for the cancel to settle, keeping the latest batch
+                # so cleanup sees the output/error files written for it
+                batch = await client.batches.cancel(batch.id)
+                cancel_deadline = loop.time() + BATCH_CANCEL_WAIT
+                while batch.status == "cancelling" and loop.time() < cancel_deadline:
+                    await asyncio.sleep(5)
+                    batch = await client.batches.retrieve(batch.id)
+                raise RuntimeError(
+                    f"Batch {batch.id} not finished after {BATCH_MAX_WAIT} seconds"
+                )
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} finished with status {batch.status}")
+
+        output = await client.files.content(batch.output_file_id)
+    finally:
+        # Batch input and output files otherwise accumulate in the account
+        await delete_files(
+            batch_file.id,
+            batch.output_file_id if batch else None,
+            batch.error_file_id if batch else None,
+        )
+
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        response = result.get("response")
+        if response and response["status_code"] == 200:
+            choice = response["body"]["choices"][0]
+            if choice["finish_reason"] == "length":
+                continue  # Truncated; retried below with a larger limit
+            custom_id = result["custom_id"]
+            summary = parse_summary(choice["message"].get("content"))
+            if summary is None:
+                continue  # Empty reply; summarized directly below
+            summaries[custom_id] = summary
+            llm_cache.set(chunk_messages[custom_ids.index(custom_id)], summary)
+
+    # Individual requests can fail inside a completed batch; summarize those directly
+    missing = [
+        i for i, custom_id in enumerate(custom_ids) if custom_id not in summaries
+    ]
+    if missing:
+        print(f"Batch {batch.id} missing {len(missing)} chunks, summarizing directly")
+        retried = await summarize_chunks([chunks[i] for i in missing])
+        for i, summary in zip(missing, retried):
+            summaries[custom_ids[i]] = summary
+
+    return [summaries[custom_id] for custom_id in custom_ids]
+
+
+async def summarize_post(
+    post: Dict[str, Union[str, int]], content: str
+) -> Optional[str]:
+    title = post.get("title")
+    chunks = chunk_text(content, max_tokens=3500, overlap=200)
+    if len(chunks) == 1:
+        return await summarize(content, title)
+
+    if len(chunks) >= BATCH_MIN_CHUNKS:
+        try:
+            chunk_summaries = await summarize_chunks_batch(
+                str(post["objectID"]), chunks
+            )
+        except (openai.OpenAIError, RuntimeError) as e:
+            print(f"Batch summarization failed: {e}. Summarizing directly.")
+            chunk_summaries = await summarize_chunks(chunks)
+    else:
+        chunk_summaries = await summarize_chunks(chunks)
+
+    try:
+        # Chunks whose summary failed are left out of the final summary
+        full_summary_text = " ".join(summary for summary in chunk_summaries if summary)
+        if not full_summary_text:
+            return None
+        return await summarize(
+            full_summary_text + "\nPlease provide a concise final summary.",
+            title,
+        )
+    except Exception as e:
+        print(f"Final summary for {title} failed: {e}")
+        return None
+
+
+async def map_title_summary(
+    session: aiohttp.ClientSession, posts: List[Dict[str, Union[str, int]]]
+) -> Dict[str, str]:
+    async def fetch_one(
+        post: Dict[str, Union[str, int]],
+    ) -> Tuple[str, Union[str, int, None]]:
+        post_type, content = await get_text_from_hn_post(session, post)
+        if post_type == "ERROR":
+            return post_type, content
 
-        comments = []
         if "ask_hn" in post["_tags"]:
-            comments = get_comments_from_post(str(post["objectID"]))
+            comments = await get_comments_from_post(session, str(post["objectID"]))
             comments_text = " ".join([comment["comment_text"] for comment in comments])
             print(f"Comments: {comments_text}")
-            content += " Comments: " + comments_text
+            content = (content or "") + " Comments: " + comments_text
+        return post_type, content
+
+    # Three stages joined by queues: fetchers -> summarizers -> collector, so
+    # later posts are fetched while earlier ones are being summarized
+    fetch_q, summ_q = asyncio.Queue(), asyncio.Queue()
+    numbered_posts = iter(enumerate(posts))  # Shared by all fetch workers
+    loop = asyncio.get_running_loop()
+    # Posts linking to the same URL wait on the first one's summary
+    url_summaries: Dict[str, asyncio.Future] = {}
+
+    async def fetch_worker() -> None:
+        for index, post in numbered_posts:
+            url = post.get("url")
+            if url in url_summaries:
+                await summ_q.put((index, post.get("title"), url_summaries[url]))
+                continue
+            if url:
+                url_summaries[url] = loop.create_future()
+            post_type, content = await fetch_one(post)
+            await fetch_q.put((index, post, post_type, content))
+
+    async def summarize_worker() -> None:
+        while (item := await fetch_q.get()) is not None:
+            index, post, post_type, content = item
+            title = post.get("title")
+            summary = None
+            # Skipped links without story text leave nothing to summarize
+            if post_type != "ERROR" and content:
+                print(f"Summarizing {title}")
+                summary = await summarize_post(post, content)
+                print(f"Title: {title}\nSummary: {summary}\n\n")
+            if post.get("url"):
+                url_summaries[post["url"]].set_result(summary)
+            await summ_q.put((index, title, summary))
+
+    async def collector() -> Dict[int, Tuple[str, object]]:
+        results = {}
+        while (item := await summ_q.get()) is not None:
+            index, title, summary = item
+            results[index] = (title, summary)
+        return results
+
+    fetchers = [asyncio.create_task(fetch_worker()) for _ in range(N_FETCH_WORKERS)]
+    summarizers = [
+        asyncio.create_task(summarize_worker()) for _ in range(N_SUMMARIZE_WORKERS)
+    ]
+    collector_task = asyncio.create_task(collector())
+    try:
+        await asyncio.gather(*fetchers)
+        for _ in summarizers:
+            await fetch_q.put(None)
+        await asyncio.gather(*summarizers)
+        await summ_q.put(None)
+        results = await collector_task
+    finally:
+        # Don't leave workers waiting on their queues if a stage failed
+        for task in fetchers + summarizers + [collector_task]:
+            task.cancel()
+
+    # Rebuild the map in feed order; repeated URLs resolve to the shared summary
+    title_summary_map = {}
+    for index in sorted(results):
+        title, summary = results[index]
+        if isinstance(summary, asyncio.Future):
+            summary = summary.result()
+        if summary is not None:
+            title_summary_map[title] = summary
+    return title_summary_map
 
-        if len(content) > 12000:
-            chunks = chunk_text(content, 12000)
-            chunk_summaries = []
 
-            for chunk in chunks:
-                chunk_summary = summarize(chunk + "\nPlease provide a brief summary.")
-                chunk_summaries.append(chunk_summary)
-                time.sleep(10)
+def curate(title_summary_map: Dict[str, str]) -> str:
+    parts = ["Here's your daily summary.", STORY_SEPARATOR]
 
-            full_summary_text = " ".join(chunk_summaries)
-            try:
-                final_summary = summarize(
-                    full_summary_text + "\nPlease provide a concise final summary.",
-                    title,
-                )
-            except Exception as e:
-                continue
-        else:
-            final_summary = summarize(content, title)
+    for summary in title_summary_map.values():
+        # Collapse longer gaps so only STORY_SEPARATOR marks a new story
+        parts.append(re.sub(r"\n{3,}", "\n\n", summary.strip()))
+        parts.append(STORY_SEPARATOR)
 
-        title_summary_map[title] = final_summary
-        print(f"Title: {title}\nSummary: {final_summary}\n\n")
-        time.sleep(15)
-    return title_summary_map
+    return "".join(parts)
 
 
-def curate(title_summary_map: Dict[str, str]) -> str:
-    podcast_script = "Here's your daily summary.\n\n"
+class AudioFileWriter(speechsdk.audio.PushAudioOutputStreamCallback):
+    """
+    Write synthesized audio to disk as the Speech SDK produces it
 
-    for i, title in enumerate(title_summary_map):
-        summary = f"{title_summary_map[title]}\n\n"
-        podcast_script += summary
+    parameters:
+        filename: Path of the audio file to write
+    """
 
-    return podcast_script
+    def __init__(self, filename: str):
+        super().__init__()
+        self.file = open(filename, "wb")
+
+    def write(self, audio_buffer: memoryview) -> int:
+        self.file.write(audio_buffer)
+        return audio_buffer.nbytes
+
+    def close(self) -> None:
+        self.file.close()
+
+
+# A dictionary of voice profiles and their options
+VOICE_CONFIGURATION = {
+    "ashley": {
+        "voice_name": "en-US-AshleyNeural",
+        "voice_pitch": "-5%",
+        "voice_rate": "+0%",
+        "voice_volume": "100",
+        "voice_style": None,
+    },
+    "grace": {
+        "voice_name": "en-US-GraceNeural",
+        "voice_pitch": "+14%",
+        "voice_rate": "+0%",
+        "voice_volume": "100",
+        "voice_style": None,
+    },
+}
+
+
+@functools.lru_cache(maxsize=4)
+def build_speech_config(key: str, region: str) -> speechsdk.SpeechConfig:
+    speech_config = speechsdk.SpeechConfig(subscription=key, region=region)
+    speech_config.set_speech_synthesis_output_format(
+        SpeechSynthesisOutputFormat.Ogg24Khz16BitMonoOpus
+    )
+    # See https://learn.microsoft.com/en-us/python/api/azure-cognitiveservices-speech/azure.cognitiveservices.speech.speechsynthesisoutputformat?view=azure-python
+    # for available options
+    return speech_config
+
+
+@functools.lru_cache(maxsize=4)
+def build_ssml_wrapper(voice_profile: str) -> Tuple[str, str]:
+    # Prosody and style are applied through SSML; the SDK ignores most of the
+    # equivalent SpeechConfig properties for plain-text requests.
+    # Returns the markup that goes before and after the escaped text.
+    profile = VOICE_CONFIGURATION[voice_profile]
+    prosody = 'pitch="{voice_pitch}" rate="{voice_rate}" volume="{voice_volume}"'
+    prefix = (
+        '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" '
+        'xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang="en-US">'
+        f'<voice name="{profile["voice_name"]}">'
+    )
+    suffix = "</voice></speak>"
+    if profile["voice_style"]:
+        # Use a speech synthesis style if specified in the voice profile
+        prefix += f'<mstts:express-as style="{profile["voice_style"]}">'
+        suffix = "</mstts:express-as>" + suffix
+    prefix += f"<prosody {prosody.format(**profile)}>"
+    suffix = "</prosody>" + suffix
+    return prefix, suffix
 
 
 class AzureSpeechSynthesizer:
@@ -191,7 +830,7 @@ class AzureSpeechSynthesizer:
     parameters:
         key: Azure Speech API key
         region: Azure Speech API region
-        voice_profile: Profile name, as set in the voice_configuration dictionary
+        voice_profile: Profile name, as set in the VOICE_CONFIGURATION dictionary
     """
 
     def __init__(self, key: str, region: str, voice_profile: str):
@@ -199,86 +838,129 @@ class AzureSpeechSynthesizer:
         self.region = region
         self.voice_profile = voice_profile
 
-        # A dictionary of voice profiles and their options
-        self.voice_configuration = {
-            "ashley": {
-                "voice_name": "en-US-AshleyNeural",
-                "voice_pitch": "-5%",
-                "voice_rate": "0",
-                "voice_volume": "100",
-                "voice_style": None,
-            },
-            "grace": {
-                "voice_name": "en-US-GraceNeural",
-                "voice_pitch": "+14%",
-                "voice_rate": "0",
-                "voice_volume": "100",
-                "voice_style": None,
-            },
-        }
-
-        self.speech_config = speechsdk.SpeechConfig(
-            subscription=self.key, region=self.region
-        )
-        # TODO: Use a generator to set the speech config properties
-        self.speech_config.speech_synthesis_voice_name = self.voice_configuration[
-            self.voice_profile
-        ]["voice_name"]
-        self.speech_config.speech_synthesis_pitch = self.voice_configuration[
-            self.voice_profile
-        ]["voice_pitch"]
-        self.speech_config.speech_synthesis_rate = self.voice_configuration[
-            self.voice_profile
-        ]["voice_rate"]
-        self.speech_config.speech_synthesis_volume = self.voice_configuration[
-            self.voice_profile
-        ]["voice_volume"]
-        if self.voice_configuration[self.voice_profile]["voice_style"]:
-            # Use a speech synthesis style if specified in the voice profile
-            self.speech_config.set_speech_synthesis_style(
-                self.voice_configuration[self.voice_profile]["voice_style"]
-            )
+        # Shared across instances; only the per-call SpeechSynthesizer is rebuilt
+        self.speech_config = build_speech_config(self.key, self.region)
+        self.ssml_prefix, self.ssml_suffix = build_ssml_wrapper(self.voice_profile)
+
+    def build_ssml(self, text: str) -> str:
+        return f"{self.ssml_prefix}{escape(text)}{self.ssml_suffix}"
 
-        self.speech_config.set_speech_synthesis_output_format(
-            SpeechSynthesisOutputFormat.Audio24Khz160KBitRateMonoMp3
+    async def synthesize(self, text: str, filename: str) -> Optional[str]:
+        # Stream audio chunks straight into the file instead of buffering them.
+        # The output stream is bound when a SpeechSynthesizer is constructed, so
+        # each call needs its own synthesizer.
+        file_writer = AudioFileWriter(filename)
+        audio_config = speechsdk.audio.AudioOutputConfig(
+            stream=speechsdk.audio.PushAudioOutputStream(file_writer)
         )
-        # See https://learn.microsoft.com/en-us/python/api/azure-cognitiveservices-speech/azure.cognitiveservices.speech.speechsynthesisoutputformat?view=azure-python
-        # for available options
 
-    def synthesize(self, text: str) -> bytes:
         # Speech generation
         speech_synthesizer = speechsdk.SpeechSynthesizer(
-            speech_config=self.speech_config, audio_config=None
+            speech_config=self.speech_config, audio_config=audio_config
         )
-        result = speech_synthesizer.speak_text_async(text).get()
+        # ResultFuture.get() blocks, so wait for it off the event loop
+        result_future = speech_synthesizer.speak_ssml_async(self.build_ssml(text))
+        result = await asyncio.to_thread(result_future.get)
+        file_writer.close()
 
         # Error handling
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
             print("Speech synthesis succeeded.")
-            return result.audio_data
+            return filename
         else:
             print("Speech synthesis failed: {}".format(result.error_details))
             return None
 
     def list_voice_profiles(self) -> None:
         print("The available voice profiles are:")
-        for profile in self.voice_configuration:
+        for profile in VOICE_CONFIGURATION:
             print(f"- {profile}")
-            for option in self.voice_configuration[profile]:
-                print(f"  - {option}: {self.voice_configuration[profile][option]}")
+            for option in VOICE_CONFIGURATION[profile]:
+                print(f"  - {option}: {VOICE_CONFIGURATION[profile][option]}")
+
+
+def split_sentences(text: str) -> List[str]:
+    try:
+        return nltk.sent_tokenize(text)
+    except LookupError:
+        # Fetch the tokenizer data on first use (the name differs across nltk versions)
+        for resource in ("punkt", "punkt_tab"):
+            nltk.download(resource, quiet=True)
+        return nltk.sent_tokenize(text)
+
+
+def join_ogg_parts(story_parts: List[List[str]], filename: str) -> None:
+    # Each part is a self-contained Ogg stream, so decode them and re-encode
+    # the joined audio as a single stream in script order
+    stories = [
+        [AudioSegment.from_ogg(part_file) for part_file in part_files]
+        for part_files in story_parts
+    ]
+    first = stories[0][0]
+    # Sentences run together, but stories get a pause between them
+    pause_frames = first.frame_rate * STORY_PAUSE_MS // 1000
+    pause = b"\0" * (pause_frames * first.sample_width * first.channels)
+    podcast = AudioSegment(
+        data=pause.join(
+            b"".join(segment.raw_data for segment in segments) for segments in stories
+        ),
+        sample_width=first.sample_width,
+        frame_rate=first.frame_rate,
+        channels=first.channels,
+    )
+    podcast.export(filename, format="ogg", codec="libopus", bitrate="48k")
+
+
+async def synthesize_sentences(
+    synthesizer: AzureSpeechSynthesizer, text: str, filename: str
+) -> Optional[str]:
+    # Split on curate's story separator so the pause only falls between stories
+    stories = [split_sentences(story) for story in text.split(STORY_SEPARATOR)]
+    stories = [sentences for sentences in stories if sentences]
+    if not stories:
+        print("Nothing to synthesize.")
+        return None
+    sentences = [sentence for story in stories for sentence in story]
+
+    with tempfile.TemporaryDirectory() as part_dir:
+
+        async def synthesize_part(index: int, sentence: str) -> Optional[str]:
+            async with TTS_SEMAPHORE:
+                return await synthesizer.synthesize(
+                    sentence, os.path.join(part_dir, f"part_{index}.ogg")
+                )
+
+        part_files = await asyncio.gather(
+            *[synthesize_part(i, sentence) for i, sentence in enumerate(sentences)]
+        )
+        if None in part_files:
+            print("Speech synthesis failed for at least one sentence.")
+            return None
+
+        # Regroup the flat list of parts by story
+        story_parts = []
+        start = 0
+        for story in stories:
+            story_parts.append(part_files[start : start + len(story)])
+            start += len(story)
 
+        await asyncio.to_thread(join_ogg_parts, story_parts, filename)
+    return filename
 
-def save_audio(podcast_script: str, speech_engine: str) -> None:
+
+async def save_audio(podcast_script: str, speech_engine: str) -> None:
     filename = "podcast"
 
     if speech_engine == "elevenlabs":
-        audio = generate(
+        # The ElevenLabs client is blocking, so run it in a worker thread
+        audio = await asyncio.to_thread(
+            generate,
             text=podcast_script,
             voice="Bella",
             model="eleven_monolingual_v1",
         )
 
-        save(audio, f"{filename}.mp3")
+        await asyncio.to_thread(save, audio, f"{filename}.mp3")
 
     elif speech_engine == "azure":
         # voice_profile options: ashley, grace
@@ -286,23 +968,32 @@ def save_audio(podcast_script: str, speech_engine: str) -> None:
             key=azure_key, region=azure_service_region, voice_profile="ashley"
         )
 
-        audio = azure_speech_synthesizer.synthesize(podcast_script)
-        save(audio, f"{filename}.mp3")
+        await synthesize_sentences(
+            azure_speech_synthesizer, podcast_script, f"{filename}.ogg"
+        )
 
 
-def main():
-    posts = get_hn_posts("story", 2)
-    # posts += get_hn_posts('ask_hn', 5)
-    title_summary_map = map_title_summary(posts)
+async def async_main():
+    # One pooled session for every fetch, so keep-alive connections are reused
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+    ) as session:
+        posts = await get_hn_posts(session, "story", 2)
+        # posts += await get_hn_posts(session, 'ask_hn', 5)
+        title_summary_map = await map_title_summary(session, posts)
     print("MAKING SCRIPT...")
     podcast_script = curate(title_summary_map)
     print("DONE")
     print("Saving audio...")
     speech_engine = "azure"  # "azure" or "elevenlabs"
-    save_audio(podcast_script, speech_engine)
+    await save_audio(podcast_script, speech_engine)
     print("DONE")
 
 
+def main():
+    asyncio.run(async_main())
+
+
 if __name__ == "__main__":
     main()
     # print("one second...")
@@ -312,4 +1003,4 @@ if __name__ == "__main__":
     # Lit 3.0 pre-releases are out! The Lit team has made a few breaking changes to trim technical debt and improve development velocity and testing stability in the core Lit project. Some changes include dropping support for IE11, removing deprecated APIs, and publishing npm modules as ES2021.
     # """
     # speech_engine = "azure"  # "azure" or "elevenlabs"
-    # save_audio(podcast_script, speech_engine)
+    # asyncio.run(save_audio(podcast_script, speech_engine))